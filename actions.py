@@ -1,6 +1,11 @@
+import re
+
 import gradio as gr
 
-from components import MAX_TASKS, all_tasks, Task
+import journal
+from components import MAX_TASKS, all_tasks, Stream, Task
+
+PIPELINE = "toolkit"
 
 
 def add_task(*visibilities):
@@ -27,12 +32,24 @@ def remove_task(*visibilities):
     return [gr.Box.update()] * MAX_TASKS + [gr.Number.update()] * MAX_TASKS
 
 
-def execute_task(task_id: int, active_index: int, error_value, *args):
+def start_run(resume: bool):
+    return (
+        gr.HighlightedText.update(value=None, visible=False),
+        journal.start_run(PIPELINE),
+        resume,
+    )
+
+
+def execute_task(
+    task_id: int, active_index: int, error_value, run_id: str, resume: bool, *args
+):
     """
     Params:
         - task_id: This will tell us which task to execute.
         - active_index: The index of the actual task that is visible.
         - error_value: I carry around whether there is an error in the execution, to be displayed at the end.
+        - run_id: The journal run this execution belongs to.
+        - resume: Whether to reuse journaled outputs of tasks whose inputs didn't change.
         - args: Other variables that will be decomposed.
     """
     n_avail_tasks = len(Task.available_tasks)
@@ -82,10 +99,21 @@ def execute_task(task_id: int, active_index: int, error_value, *args):
                 i * n_avail_tasks + int(other_active_index)
             ]
 
+    # Only variables used by the task make it to the journal key.
+    used_vars = set(re.findall(r"{(\w+)}", " ".join(str(i) for i in task_inputs)))
+
     try:
         # Task logic gets inserted into the right index
-        outputs[active_index] = all_tasks[task_id].execute(
-            active_index, *task_inputs, vars_in_scope=vars_in_scope
+        outputs[active_index] = journal.run_step(
+            run_id,
+            PIPELINE,
+            str(task_id),
+            [active_index, task_inputs]
+            + [vars_in_scope.get(v) for v in sorted(used_vars)],
+            lambda: all_tasks[task_id].execute(
+                active_index, *task_inputs, vars_in_scope=vars_in_scope
+            ),
+            resume=resume,
         )
         return outputs + [error_update]
     except Exception as e:
@@ -99,3 +127,21 @@ def execute_task(task_id: int, active_index: int, error_value, *args):
                 visible=True,
             )
         ]
+
+
+def materialize_outputs(task_id: int, *outputs):
+    """Replaces streamed outputs with their items once the streams finish."""
+    updates = []
+    error_update = gr.update()
+    for output in outputs:
+        try:
+            updates.append(
+                Stream.materialize(output) if Stream.get(output) else gr.update()
+            )
+        except Exception as e:
+            updates.append(f"ERROR :: {e}")
+            error_update = gr.HighlightedText.update(
+                value=[(f"Error in Task {int(task_id)} :: {e}", "ERROR")],
+                visible=True,
+            )
+    return updates + [error_update]
@@ -1 +1 @@
-from . import image, llm
\ No newline at end of file
+from . import compress, image, llm, packing
\ No newline at end of file
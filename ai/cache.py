@@ -0,0 +1,95 @@
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+SIMHASH_BITS = 64
+SHINGLE_SIZE = 3
+
+
+def _shingles(text: str) -> List[str]:
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < SHINGLE_SIZE:
+        return [" ".join(words)]
+    return [
+        " ".join(words[i : i + SHINGLE_SIZE])
+        for i in range(len(words) - SHINGLE_SIZE + 1)
+    ]
+
+
+def simhash(text: str) -> int:
+    weights = [0] * SIMHASH_BITS
+    for shingle in _shingles(text):
+        h = int.from_bytes(
+            hashlib.blake2b(shingle.encode(), digest_size=SIMHASH_BITS // 8).digest(),
+            "big",
+        )
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += 1 if h >> bit & 1 else -1
+    return sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)
+
+
+def similarity(a: int, b: int) -> float:
+    return 1 - bin(a ^ b).count("1") / SIMHASH_BITS
+
+
+class NearDuplicateCache:
+    """
+    Caches values by instruction and by the SimHash of a text, so texts that differ
+    in only a few words share a value. Lookups only compare texts with the same
+    instruction, and entries older than ttl seconds are ignored.
+    """
+
+    def __init__(self, threshold: float, ttl: float, max_entries: int = 256):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.hit_similarities: Deque[float] = deque(maxlen=100)
+        # instruction -> [(simhash, time, value)], most recent last
+        self._entries: "OrderedDict[str, List[Tuple[int, float, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, instruction: str, text: str) -> Optional[Tuple[Any, float]]:
+        """Returns the most similar cached value and its similarity, if any."""
+        fingerprint = simhash(text)
+        now = time.time()
+        with self._lock:
+            best: Optional[Tuple[Any, float]] = None
+            for h, created, value in self._entries.get(instruction, []):
+                score = similarity(fingerprint, h)
+                if now - created < self.ttl and score >= self.threshold:
+                    if best is None or score > best[1]:
+                        best = (value, score)
+            if best:
+                self.hits += 1
+                self.hit_similarities.append(best[1])
+            else:
+                self.misses += 1
+            return best
+
+    def put(self, instruction: str, text: str, value: Any) -> None:
+        with self._lock:
+            entries = self._entries.setdefault(instruction, [])
+            self._entries.move_to_end(instruction)
+            entries.append((simhash(text), time.time(), value))
+            del entries[: -self.max_entries]
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "threshold": self.threshold,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "recent_hit_similarities": list(self.hit_similarities),
+                "instructions": len(self._entries),
+                "entries": sum(len(e) for e in self._entries.values()),
+            }
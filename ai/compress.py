@@ -0,0 +1,102 @@
+import hashlib
+import re
+import threading
+from collections import Counter, OrderedDict
+
+from . import llm
+
+# Variables above this many tokens are compressed down to TARGET_TOKENS.
+COMPRESS_ABOVE_TOKENS = 1000
+TARGET_TOKENS = 1000
+MAX_CACHED = 256
+
+# Whole navigation, banner and footer items. Lines made only of these are dropped.
+BOILERPLATE = re.compile(
+    r"((accept|allow|manage|reject)( all)? cookies|cookie (policy|settings)|"
+    r"privacy( policy)?|terms of (use|service)|terms (and|&) conditions|"
+    r"(©|copyright\b).*|.*all rights reserved|sign (in|up)|log ?(in|out)|"
+    r"subscribe( now)?|subscribe to (our|the) newsletter|skip to (main )?content)"
+    r"[.!]?",
+    re.IGNORECASE,
+)
+NAVIGATION_SEPARATOR = re.compile(r"\s*[|·•]\s*")
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+STOPWORDS = set(
+    "a an and are as at be by for from has have in is it its of on or that the this "
+    "to was were will with you your we our".split()
+)
+
+_cache: "OrderedDict[str, str]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def compress(text: str, max_tokens: int = TARGET_TOKENS) -> str:
+    """
+    Extractive, local reduction of text to about max_tokens. Removes whitespace,
+    duplicate and boilerplate lines, then keeps the highest ranked sentences in
+    their original order. Results are cached by the hash of text.
+    """
+    key = f"{hashlib.sha256(text.encode()).hexdigest()}:{max_tokens}"
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    compressed = _compress(text, max_tokens)
+    print(
+        f"Compressed a variable from {llm.count_tokens(text)} to {llm.count_tokens(compressed)} tokens."
+    )
+    with _cache_lock:
+        _cache[key] = compressed
+        while len(_cache) > MAX_CACHED:
+            _cache.popitem(last=False)
+    return compressed
+
+
+def _compress(text: str, max_tokens: int) -> str:
+    lines = []
+    seen = set()
+    for line in text.splitlines():
+        line = " ".join(line.split())
+        if not line or line.lower() in seen:
+            continue
+        seen.add(line.lower())
+        if all(
+            BOILERPLATE.fullmatch(item)
+            for item in NAVIGATION_SEPARATOR.split(line)
+            if item
+        ):
+            continue
+        lines.append(line)
+    text = "\n".join(lines)
+    if llm.count_tokens(text) <= max_tokens:
+        return text
+
+    sentences = [s for line in lines for s in SENTENCE_END.split(line) if s]
+    frequencies = Counter(w for s in sentences for w in _words(s))
+
+    def score(i: int) -> float:
+        words = _words(sentences[i])
+        if not words:
+            return 0.0
+        # Average word frequency, slightly favoring the beginning of the text.
+        return sum(frequencies[w] for w in words) / len(words) * (1 + 1 / (1 + i / 10))
+
+    kept = {}
+    budget = max_tokens
+    for i in sorted(range(len(sentences)), key=score, reverse=True):
+        tokens = llm.count_tokens(sentences[i])
+        if tokens <= budget:
+            kept[i] = sentences[i]
+            budget -= tokens
+        elif not kept:
+            # Unpunctuated text, like a list of URLs, is one long sentence.
+            kept[i] = llm.truncate(sentences[i], budget)
+            budget -= llm.count_tokens(kept[i])
+    if not kept:
+        return llm.truncate(text, max_tokens)
+    return "\n".join(kept[i] for i in sorted(kept))
+
+
+def _words(sentence: str):
+    return [w for w in re.findall(r"\w+", sentence.lower()) if w not in STOPWORDS]
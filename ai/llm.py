@@ -1,9 +1,20 @@
+import functools
+import hashlib
+import json
 import os
-from typing import Any, Dict, List, Optional
+import threading
+import time
+import traceback
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import Future
+from typing import Any, Deque, Dict, List, Optional, Tuple, Union
 
 import openai
+import tiktoken
 from dotenv import load_dotenv
 
+from .cache import NearDuplicateCache
+
 load_dotenv()
 
 
@@ -11,24 +22,303 @@ openai.api_key = os.environ["OPENAI_KEY_PERSONAL"]
 MODEL = "gpt-3.5-turbo"
 TEMPERATURE = 0.7
 
+AUTO = "auto"
+# Cheapest/fastest first. (name, context window in tokens)
+MODELS: List[Tuple[str, int]] = [
+    (MODEL, 4096),
+    ("gpt-3.5-turbo-16k", 16384),
+]
+# USD per 1k (prompt, completion) tokens.
+PRICES: Dict[str, Tuple[float, float]] = {
+    MODEL: (0.0015, 0.002),
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+}
+# Room left in the context window for the completion.
+COMPLETION_TOKENS = 1024
+# 0 disables the limiter.
+TOKENS_PER_MINUTE = int(os.environ.get("LLM_TOKENS_PER_MINUTE", 0))
+
+usage: Dict[str, Dict[str, float]] = defaultdict(
+    lambda: {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0}
+)
+_usage_lock = threading.Lock()
+_sent_tokens: Deque[Tuple[float, int]] = deque()
+_rate_lock = threading.Lock()
+
+routing_log: Deque[Dict[str, Any]] = deque(maxlen=1000)
+
+# Identical concurrent requests share one upstream call. Requests above
+# COALESCE_MAX_TEMPERATURE are non-deterministic and are sent individually.
+COALESCE = os.environ.get("LLM_COALESCE", "1") == "1"
+COALESCE_MAX_TEMPERATURE = float(
+    os.environ.get("LLM_COALESCE_MAX_TEMPERATURE", TEMPERATURE)
+)
+
+_in_flight: Dict[str, Future] = {}
+_in_flight_lock = threading.Lock()
+
+# Opt-in. Prompts built from the same instruction whose SimHash similarity to a
+# recent prompt is above the threshold get that prompt's completion.
+NEAR_DUP_CACHE = os.environ.get("LLM_NEAR_DUP_CACHE", "0") == "1"
+near_dup_cache = NearDuplicateCache(
+    threshold=float(os.environ.get("LLM_NEAR_DUP_THRESHOLD", 0.95)),
+    ttl=float(os.environ.get("LLM_NEAR_DUP_TTL", 60 * 60)),
+)
+
+
+def model_names() -> List[str]:
+    return [name for name, _ in MODELS]
+
+
+def context_window(model: str) -> int:
+    for name, window in MODELS:
+        if name == model:
+            return window
+    return MODELS[0][1]
+
+
+class PromptTooLong(ValueError):
+    def __init__(self, prompt_tokens: int, max_prompt_tokens: int, model: str):
+        super().__init__(
+            f"The prompt has {prompt_tokens} tokens, but {model} fits at most {max_prompt_tokens}."
+        )
+        self.prompt_tokens = prompt_tokens
+        self.max_prompt_tokens = max_prompt_tokens
+        self.model = model
+
+
+class _ApproximateEncoding:
+    """About 4 characters per token. Used when tiktoken can't load its encoding."""
+
+    CHARS_PER_TOKEN = 4
+
+    def encode(self, text: str, **kwargs) -> List[str]:
+        n = self.CHARS_PER_TOKEN
+        return [text[i : i + n] for i in range(0, len(text), n)]
+
+    def decode(self, tokens: List[str]) -> str:
+        return "".join(tokens)
+
+
+@functools.lru_cache(maxsize=1)
+def _encoding() -> Union[tiktoken.Encoding, _ApproximateEncoding]:
+    # Shared by every model in MODELS.
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        # The encoding is downloaded on first use.
+        traceback.print_exc()
+        print("Unable to load the tokenizer. Estimating tokens from characters.")
+        return _ApproximateEncoding()
+
+
+MAX_CACHED_TOKEN_COUNTS = 4096
+_token_counts: "OrderedDict[str, int]" = OrderedDict()
+_token_counts_lock = threading.Lock()
+
+
+def count_tokens(text: str) -> int:
+    # Keyed by hash, so large texts aren't kept alive by the cache.
+    key = hashlib.sha256(text.encode()).hexdigest()
+    with _token_counts_lock:
+        if key in _token_counts:
+            _token_counts.move_to_end(key)
+            return _token_counts[key]
+
+    tokens = len(_encoding().encode(text, disallowed_special=()))
+    with _token_counts_lock:
+        _token_counts[key] = tokens
+        while len(_token_counts) > MAX_CACHED_TOKEN_COUNTS:
+            _token_counts.popitem(last=False)
+    return tokens
+
+
+def truncate(text: str, max_tokens: int) -> str:
+    """Keeps the head and the tail of text, so that it fits in max_tokens."""
+    tokens = _encoding().encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    marker = "\n...\n"
+    keep = max(max_tokens - count_tokens(marker), 0)
+    head, tail = keep - keep // 2, keep // 2
+    return (
+        _encoding().decode(tokens[:head])
+        + marker
+        + (_encoding().decode(tokens[-tail:]) if tail else "")
+    )
+
+
+def split(text: str, max_tokens: int) -> List[str]:
+    tokens = _encoding().encode(text, disallowed_special=())
+    step = max(max_tokens, 1)
+    return [
+        _encoding().decode(tokens[i : i + step]) for i in range(0, len(tokens), step)
+    ]
+
+
+def count_message_tokens(messages: List[Dict[str, str]]) -> int:
+    # Every message carries a few tokens of overhead for role and separators.
+    return sum(count_tokens(m["content"]) + 4 for m in messages) + 3
+
+
+def route(
+    messages: List[Dict[str, str]], model: Optional[str] = None, log: bool = True
+) -> str:
+    """
+    Picks the cheapest model whose context window fits the prompt plus
+    COMPLETION_TOKENS. An explicit model (other than "auto") is kept as is,
+    unless the prompt overflows it, in which case it falls back to a larger one.
+    Without log, the decision isn't recorded, for prompts that may not be sent.
+    """
+    prompt_tokens = count_message_tokens(messages)
+    needed = prompt_tokens + COMPLETION_TOKENS
+    requested = model if model and model != AUTO else None
+
+    if requested and context_window(requested) >= needed:
+        chosen, reason = requested, "requested"
+    else:
+        fits = [name for name, window in MODELS if window >= needed]
+        if fits:
+            chosen = fits[0]
+            reason = "overflow fallback" if requested else "smallest that fits"
+        else:
+            chosen = max(MODELS, key=lambda m: m[1])[0]
+            reason = "largest available"
+
+    if not log:
+        return chosen
+    routing_log.append(
+        {
+            "time": time.time(),
+            "requested": requested or AUTO,
+            "model": chosen,
+            "prompt_tokens": prompt_tokens,
+            "reason": reason,
+        }
+    )
+    print(f"Routing {prompt_tokens} prompt tokens to {chosen} ({reason}).")
+    return chosen
+
+
+def preflight(messages: List[Dict[str, str]], model: str) -> int:
+    """
+    Counts the prompt tokens and raises PromptTooLong, before anything is sent,
+    if the prompt leaves less than COMPLETION_TOKENS for the completion.
+    """
+    prompt_tokens = count_message_tokens(messages)
+    max_prompt_tokens = context_window(model) - COMPLETION_TOKENS
+    if prompt_tokens > max_prompt_tokens:
+        raise PromptTooLong(prompt_tokens, max_prompt_tokens, model)
+    return prompt_tokens
+
+
+def _wait_for_rate_limit(tokens: int) -> None:
+    if not TOKENS_PER_MINUTE:
+        return
+    while True:
+        with _rate_lock:
+            now = time.time()
+            while _sent_tokens and now - _sent_tokens[0][0] > 60:
+                _sent_tokens.popleft()
+            in_window = sum(n for _, n in _sent_tokens)
+            # A single oversized request is let through on an empty window.
+            if not _sent_tokens or in_window + tokens <= TOKENS_PER_MINUTE:
+                _sent_tokens.append((now, tokens))
+                return
+            wait = 60 - (now - _sent_tokens[0][0])
+        time.sleep(max(wait, 0.1))
+
+
+def _record_usage(model: str, prompt_tokens: int, response: Dict[str, Any]) -> None:
+    completion_tokens = response.get("usage", {}).get("completion_tokens", 0)
+    prompt_price, completion_price = PRICES.get(model, (0.0, 0.0))
+    with _usage_lock:
+        model_usage = usage[model]
+        model_usage["requests"] += 1
+        model_usage["prompt_tokens"] += prompt_tokens
+        model_usage["completion_tokens"] += completion_tokens
+        model_usage["cost"] += (
+            prompt_tokens * prompt_price + completion_tokens * completion_price
+        ) / 1000
+
 
 def call(
     messages: List[Dict[str, str]],
     model: Optional[str] = None,
     temperature: Optional[float] = None,
     stop: Optional[str] = None,
+    coalesce: bool = True,
+    instruction: Optional[str] = None,
 ) -> Dict[str, Any]:
-    if not model:
-        model = MODEL
+    """
+    instruction identifies the template the messages were built from. Only calls
+    that pass it can be served by the near-duplicate cache.
+    """
+    model = route(messages, model)
     if temperature is None:
         temperature = TEMPERATURE
 
-    return openai.ChatCompletion.create(  # type: ignore
-        model=model,
-        messages=messages,
-        temperature=temperature,
-        stop=stop,
-    )
+    prompt_tokens = preflight(messages, model)
+
+    if NEAR_DUP_CACHE and instruction:
+        cache_instruction = json.dumps([model, temperature, stop, instruction])
+        cache_text = "\n".join(m["content"] for m in messages)
+        cached = near_dup_cache.get(cache_instruction, cache_text)
+        if cached:
+            print(f"Near-duplicate cache hit. Similarity :: {cached[1]:.3f}")
+            return cached[0]
+
+    def create() -> Dict[str, Any]:
+        _wait_for_rate_limit(prompt_tokens + COMPLETION_TOKENS)
+        response = openai.ChatCompletion.create(  # type: ignore
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            stop=stop,
+        )
+        _record_usage(model, prompt_tokens, response)
+        return response
+
+    if not (coalesce and COALESCE) or temperature > COALESCE_MAX_TEMPERATURE:
+        response = create()
+    else:
+        response = _single_flight(
+            _request_key(messages, model, temperature, stop), create
+        )
+    if NEAR_DUP_CACHE and instruction:
+        near_dup_cache.put(cache_instruction, cache_text, response)
+    return response
+
+
+def _request_key(
+    messages: List[Dict[str, str]], model: str, temperature: float, stop: Optional[str]
+) -> str:
+    normalized = [
+        {"role": m["role"], "content": " ".join(m["content"].split())} for m in messages
+    ]
+    return json.dumps([model, normalized, temperature, stop], sort_keys=True)
+
+
+def _single_flight(key: str, create) -> Dict[str, Any]:
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        leader = future is None
+        if leader:
+            future = Future()
+            _in_flight[key] = future
+
+    if not leader:
+        print("Joining an identical in-flight LLM call.")
+        return future.result()
+
+    try:
+        future.set_result(create())
+    except Exception as e:
+        future.set_exception(e)
+    finally:
+        with _in_flight_lock:
+            del _in_flight[key]
+    return future.result()
 
 
 def next(
@@ -36,5 +326,8 @@ def next(
     model: Optional[str] = None,
     temperature: Optional[float] = None,
     stop: Optional[str] = None,
+    coalesce: bool = True,
+    instruction: Optional[str] = None,
 ) -> str:
-    return call(messages, model, temperature, stop)["choices"][0]["message"]["content"]
+    response = call(messages, model, temperature, stop, coalesce, instruction)
+    return response["choices"][0]["message"]["content"]
@@ -0,0 +1,145 @@
+import json
+import os
+import re
+import threading
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from . import llm
+
+# Opt-in. Small prompts from the same template, model and temperature that arrive
+# within WINDOW seconds are sent as one request.
+PACKING = os.environ.get("LLM_PACKING", "0") == "1"
+WINDOW = float(os.environ.get("LLM_PACK_WINDOW", 0.05))
+# At most the pool size of map mode (TaskComponent.MAX_WORKERS), or batches
+# never fill up and always wait the whole window.
+MAX_ITEMS = int(os.environ.get("LLM_PACK_MAX_ITEMS", 8))
+MAX_ITEM_TOKENS = 200
+
+stats = {"packed_requests": 0, "packed_items": 0, "fallbacks": 0}
+
+
+class _Batch:
+    def __init__(self):
+        self.items: List[Tuple[str, Future]] = []
+        self.full = threading.Event()
+
+
+_batches: Dict[Tuple[str, float, str], _Batch] = {}
+_lock = threading.Lock()
+
+
+def next(
+    prompt: str,
+    instruction: str,
+    model: Optional[str] = None,
+    temperature: Optional[float] = None,
+) -> str:
+    """
+    Like llm.next for a single user prompt, but packs it with compatible prompts
+    built from the same instruction. Falls back to individual calls when the packed
+    response can't be parsed.
+    """
+    messages = [{"role": "user", "content": prompt}]
+    if not PACKING or llm.count_tokens(prompt) > MAX_ITEM_TOKENS:
+        return llm.next(messages, model, temperature, instruction=instruction)
+
+    # The packed request and any fallback are routed, and logged, when sent.
+    model = llm.route(messages, model, log=False)
+    if temperature is None:
+        temperature = llm.TEMPERATURE
+    key = (model, temperature, instruction)
+
+    future: Future = Future()
+    with _lock:
+        batch = _batches.get(key)
+        leader = batch is None
+        if leader:
+            batch = _batches[key] = _Batch()
+        batch.items.append((prompt, future))
+        if len(batch.items) >= MAX_ITEMS:
+            del _batches[key]
+            batch.full.set()
+
+    if leader:
+        batch.full.wait(WINDOW)
+        with _lock:
+            if _batches.get(key) is batch:
+                del _batches[key]
+        _send(batch, model, temperature)
+    return future.result()
+
+
+def _send(batch: _Batch, model: str, temperature: float) -> None:
+    prompts = [prompt for prompt, _ in batch.items]
+    answers = None
+    if len(prompts) > 1:
+        try:
+            answers = _unpack(
+                llm.next(
+                    [{"role": "user", "content": _pack(prompts)}], model, temperature
+                ),
+                len(prompts),
+            )
+        except Exception:
+            traceback.print_exc()
+        with _lock:
+            if answers is None:
+                stats["fallbacks"] += 1
+            else:
+                stats["packed_requests"] += 1
+                stats["packed_items"] += len(prompts)
+        if answers is None:
+            print(
+                f"Unable to unpack {len(prompts)} packed prompts. Sending them one by one."
+            )
+
+    if answers is not None:
+        for (_, future), answer in zip(batch.items, answers):
+            future.set_result(answer)
+        return
+
+    def individual(item: Tuple[str, Future]) -> None:
+        prompt, future = item
+        try:
+            future.set_result(
+                llm.next([{"role": "user", "content": prompt}], model, temperature)
+            )
+        except Exception as e:
+            future.set_exception(e)
+
+    with ThreadPoolExecutor(len(batch.items)) as executor:
+        list(executor.map(individual, batch.items))
+
+
+def _pack(prompts: List[str]) -> str:
+    requests = "\n\n".join(
+        f"Request {i}:\n{prompt}" for i, prompt in enumerate(prompts, 1)
+    )
+    return f"""Answer each of the following {len(prompts)} requests independently.
+
+{requests}
+
+Reply only with a valid JSON object that maps each request number to its answer:
+```
+{{
+    "1": Answer to request 1,
+    ...
+}}
+```"""
+
+
+def _unpack(response: str, n: int) -> Optional[List[str]]:
+    match = re.search("{.*}", response, re.DOTALL)
+    if not match:
+        return None
+    try:
+        answers = json.loads(match.group(0))
+    except ValueError:
+        return None
+    if not isinstance(answers, dict) or set(answers) != {
+        str(i) for i in range(1, n + 1)
+    }:
+        return None
+    return [str(answers[str(i)]) for i in range(1, n + 1)]
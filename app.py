@@ -1,6 +1,9 @@
+import functools
+
 import gradio as gr
 
 import actions as a
+import snapshots
 from examples import (
     authenticate_google,
     best_clubs,
@@ -33,7 +36,11 @@ with gr.Blocks() as demo:
             add_task_btn = gr.Button("Add task")
             remove_task_btn = gr.Button("Remove task")
         error_message = gr.HighlightedText(value=None, visible=False)
-        execute_btn = gr.Button("Execute tasks")
+        run_id = gr.Textbox(visible=False)
+        resume = gr.Checkbox(visible=False)
+        with gr.Row():
+            execute_btn = gr.Button("Execute tasks")
+            resume_btn = gr.Button("Resume from the first failed or changed task")
 
         # Edit layout
         add_task_btn.click(
@@ -48,21 +55,35 @@ with gr.Blocks() as demo:
         )
 
         # Sequential execution
-        execution_event = execute_btn.click(
-            # Clear error message
-            lambda: gr.HighlightedText.update(value=None, visible=False),
-            inputs=[],
-            outputs=[error_message],
-        )
-        for task in all_tasks.values():
-            execution_event = execution_event.then(
-                a.execute_task,
-                inputs=[task.component_id, task.active_index, error_message]
-                + task.inputs
-                + [t.active_index for t in all_tasks.values()]
-                + [o for t in all_tasks.values() for o in t.outputs],
-                outputs=task.outputs + [error_message],
+        for btn, resume_value in [(execute_btn, False), (resume_btn, True)]:
+            execution_event = btn.click(
+                # Clear error message and start a new journal run
+                functools.partial(a.start_run, resume_value),
+                inputs=[],
+                outputs=[error_message, run_id, resume],
             )
+            for task in all_tasks.values():
+                execution_event = execution_event.then(
+                    a.execute_task,
+                    inputs=[
+                        task.component_id,
+                        task.active_index,
+                        error_message,
+                        run_id,
+                        resume,
+                    ]
+                    + task.inputs
+                    + [t.active_index for t in all_tasks.values()]
+                    + [o for t in all_tasks.values() for o in t.outputs],
+                    outputs=task.outputs + [error_message],
+                )
+                # Streamed outputs are filled in when they finish, without blocking
+                # the next tasks.
+                execution_event.then(
+                    a.materialize_outputs,
+                    inputs=[task.component_id] + task.outputs,
+                    outputs=task.outputs + [error_message],
+                )
 
     # Examples
     summarize_website.render()
@@ -71,4 +92,5 @@ with gr.Blocks() as demo:
     generate_ad.render()
     authenticate_google.render()
 
+snapshots.start_warmer()
 demo.launch()
@@ -1,13 +1,39 @@
+import ast
+import cProfile
+import hashlib
+import inspect
+import io
 import json
+import os
+import pstats
 import re
+import subprocess
+import sys
+import threading
+import time
 import traceback
+import tracemalloc
+import uuid
+from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor
 from abc import ABC, abstractmethod
-from typing import Any, Dict, List, Optional, Union
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import gradio as gr
 
 import ai
+import sandbox
+import web
 
 
 class Component(ABC):
@@ -33,6 +59,91 @@ class Component(ABC):
         ...
 
 
+class Stream:
+    """
+    Output of a toolkit function that returns a generator.
+    Items are pulled in a background thread and can be consumed by downstream tasks
+    while they are being produced. Tasks refer to a stream through its key, which is
+    displayed as the task output until the stream is materialized.
+    """
+
+    # Finished streams beyond this many are forgotten. Running ones never are.
+    MAX_STREAMS = 32
+    KEY = re.compile(r"<stream [0-9a-f]{8}>")
+    _streams: "OrderedDict[str, Stream]" = OrderedDict()
+    _lock = threading.Lock()
+
+    def __init__(self, iterable: Iterable):
+        self.key = f"<stream {uuid.uuid4().hex[:8]}>"
+        self._items: List[Any] = []
+        self._done = False
+        self._error: Optional[Exception] = None
+        self._condition = threading.Condition()
+
+        with Stream._lock:
+            Stream._streams[self.key] = self
+            finished = [k for k, s in Stream._streams.items() if s._done]
+            for key in finished[: max(len(Stream._streams) - Stream.MAX_STREAMS, 0)]:
+                del Stream._streams[key]
+        threading.Thread(
+            target=self._produce, args=(iter(iterable),), daemon=True
+        ).start()
+
+    @classmethod
+    def get(cls, value: Any) -> Optional["Stream"]:
+        if isinstance(value, str) and cls.KEY.fullmatch(value):
+            with cls._lock:
+                stream = cls._streams.get(value)
+            if not stream:
+                raise ValueError(
+                    f"The output {value} is no longer available. Execute the task that produced it again."
+                )
+            return stream
+        return None
+
+    @classmethod
+    def materialize(cls, value: Any) -> Any:
+        """
+        Waits for the stream referred to by value, if any, and returns its items as a
+        string. Errors of the generator are raised.
+        """
+        stream = cls.get(value)
+        return str(stream) if stream else value
+
+    def _produce(self, iterator: Iterator) -> None:
+        try:
+            for item in iterator:
+                with self._condition:
+                    self._items.append(item)
+                    self._condition.notify_all()
+        except Exception as e:
+            traceback.print_exc()
+            self._error = e
+        finally:
+            with self._condition:
+                self._done = True
+                self._condition.notify_all()
+
+    def __iter__(self) -> Iterator:
+        i = 0
+        while True:
+            with self._condition:
+                while i >= len(self._items) and not self._done:
+                    self._condition.wait()
+                if i < len(self._items):
+                    item = self._items[i]
+                elif self._error:
+                    raise self._error
+                else:
+                    return
+            yield item
+            i += 1
+
+    def __str__(self) -> str:
+        # Blocks until the stream is exhausted.
+        return str(list(self))
+
+
 class Input(Component):
     vname = "v"
 
@@ -48,6 +159,10 @@ class Input(Component):
 
 class TaskComponent(Component, ABC):
     vname = "t"
+    MAX_WORKERS = 8
+    MAX_CACHED_ELEMENTS = 1000
+    _element_cache: "OrderedDict[str, Any]" = OrderedDict()
+    _element_cache_lock = threading.Lock()
 
     def __init__(self, id_: int, value: str = "", visible: bool = False):
         super().__init__(id_)
@@ -68,7 +183,94 @@ class TaskComponent(Component, ABC):
                 raise KeyError(
                     f"The variables :: {undefined_vars} in task :: {self._id} are being used before being defined."
                 )
-            return input.format(**vars_in_scope)
+            return input.format(
+                **{k: Stream.get(v) or v for k, v in vars_in_scope.items()}
+            )
+
+    def compress_vars(
+        self, input: str, vars_in_scope: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        """Returns vars_in_scope with the large variables used by input compressed."""
+        vars_in_scope = dict(vars_in_scope)
+        for name in re.findall(r"{(\w+)}", input):
+            if name not in vars_in_scope:
+                continue
+            value = str(Stream.get(vars_in_scope[name]) or vars_in_scope[name])
+            if ai.llm.count_tokens(value) > ai.compress.COMPRESS_ABOVE_TOKENS:
+                vars_in_scope[name] = ai.compress.compress(value)
+        return vars_in_scope
+
+    def stream_vars(
+        self, input: str, vars_in_scope: Dict[str, Any]
+    ) -> Dict[str, Stream]:
+        streams = {}
+        for name in re.findall(r"{(\w+)}", input):
+            stream = Stream.get(vars_in_scope.get(name))
+            if stream:
+                streams[name] = stream
+        return streams
+
+    def map_items(self, items: Iterable, func: Callable[[Any], Any]) -> List[Any]:
+        # Items are submitted as they are produced, so work on the first item
+        # overlaps with producing the next one.
+        with ThreadPoolExecutor(self.MAX_WORKERS) as executor:
+            futures = [executor.submit(func, item) for item in items]
+        return [f.result() for f in futures]
+
+    def list_var(
+        self, input: str, vars_in_scope: Dict[str, Any]
+    ) -> Tuple[str, Iterable]:
+        for name in re.findall(r"{(\w+)}", input):
+            value = vars_in_scope.get(name)
+            stream = Stream.get(value)
+            if stream:
+                return name, stream
+            try:
+                items = ast.literal_eval(str(value))
+            except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+                continue
+            if isinstance(items, (list, tuple)):
+                return name, items
+        raise ValueError(
+            f"Task :: {self._id} runs once per element, but none of its variables is a list."
+        )
+
+    def map_elements(
+        self, items: Iterable, func: Callable[[Any], Any], cache_key: str
+    ) -> List[Any]:
+        """
+        Runs func once per element on a bounded pool, caching results per element.
+        Failed elements are reported in place, as long as some element succeeded.
+        """
+        failures = []
+
+        def run(indexed_item):
+            i, item = indexed_item
+            key = hashlib.sha256(f"{cache_key}\0{item!r}".encode()).hexdigest()
+            with self._element_cache_lock:
+                if key in self._element_cache:
+                    self._element_cache.move_to_end(key)
+                    return self._element_cache[key]
+            try:
+                output = func(item)
+                if inspect.isgenerator(output):
+                    output = list(output)
+            except Exception as e:
+                traceback.print_exc()
+                failures.append(i)
+                return f"ERROR :: {e}"
+            with self._element_cache_lock:
+                self._element_cache[key] = output
+                while len(self._element_cache) > self.MAX_CACHED_ELEMENTS:
+                    self._element_cache.popitem(last=False)
+            return output
+
+        outputs = self.map_items(enumerate(items), run)
+        if failures:
+            if len(failures) == len(outputs):
+                raise RuntimeError(f"Task :: {self._id} failed for every element.")
+            print(f"Task :: {self._id} failed for elements :: {sorted(failures)}")
+        return outputs
 
     @property
     def n_inputs(self) -> int:
@@ -79,6 +281,11 @@ class TaskComponent(Component, ABC):
     def inputs(self) -> List[gr.Textbox]:
         ...
 
+    @property
+    @abstractmethod
+    def initial_inputs(self) -> List[Any]:
+        ...
+
     @abstractmethod
     def execute(self, *args, vars_in_scope: Dict[str, Any]):
         ...
@@ -86,17 +293,42 @@ class TaskComponent(Component, ABC):
 
 class AITask(TaskComponent):
     name = "AI Task"
+    # - reject: Fail before sending the prompt.
+    # - truncate: Keep the head and tail of the largest variable.
+    # - chunk: Prompt once per chunk of the largest variable.
+    OVERFLOW_POLICIES = ["reject", "truncate", "chunk"]
 
     def _render(self) -> gr.Box:
         with gr.Box(visible=self._initial_visbility) as gr_component:
             with gr.Row():
-                self.input = gr.Textbox(
-                    label="Instructions",
-                    lines=10,
-                    interactive=True,
-                    placeholder="What would you like ChatGPT to do?",
-                    value=self._initial_value,
-                )
+                with gr.Column():
+                    self.input = gr.Textbox(
+                        label="Instructions",
+                        lines=10,
+                        interactive=True,
+                        placeholder="What would you like ChatGPT to do?",
+                        value=self._initial_value,
+                    )
+                    self.model = gr.Dropdown(
+                        [ai.llm.AUTO] + ai.llm.model_names(),
+                        value=ai.llm.AUTO,
+                        label="Model",
+                        interactive=True,
+                    )
+                    self.map_input = gr.Checkbox(
+                        label="Run once per element of a list variable",
+                        interactive=True,
+                    )
+                    self.overflow_policy = gr.Dropdown(
+                        self.OVERFLOW_POLICIES,
+                        value=self.OVERFLOW_POLICIES[0],
+                        label="If the prompt is too long",
+                        interactive=True,
+                    )
+                    self.compress = gr.Checkbox(
+                        label="Compress large variables",
+                        interactive=True,
+                    )
                 self.output = gr.Textbox(
                     label=f"Output: {{{self.vname}{self._id}}}",
                     lines=10,
@@ -106,16 +338,121 @@ class AITask(TaskComponent):
 
     @property
     def inputs(self) -> List[gr.Textbox]:
-        return [self.input]
+        return [
+            self.input,
+            self.model,
+            self.map_input,
+            self.overflow_policy,
+            self.compress,
+        ]
+
+    @property
+    def initial_inputs(self) -> List[Any]:
+        return [
+            self._initial_value,
+            ai.llm.AUTO,
+            False,
+            self.OVERFLOW_POLICIES[0],
+            False,
+        ]
+
+    def execute(
+        self,
+        prompt: str,
+        model: str,
+        map_input: bool,
+        overflow_policy: str,
+        compress: bool,
+        vars_in_scope: Dict[str, Any],
+    ) -> Optional[str]:
+        if map_input:
+            # Prompt once per element. Streamed elements are prompted as they arrive.
+            # Otherwise, streams are materialized when the prompt is formatted.
+            name, items = self.list_var(prompt, vars_in_scope)
+            prompt_vars = re.findall(r"{(\w+)}", prompt)
+            outputs = self.map_elements(
+                items,
+                lambda item: self._call(
+                    prompt,
+                    {**vars_in_scope, name: item},
+                    model,
+                    overflow_policy,
+                    compress,
+                    # Small per-element prompts can share requests.
+                    packed=True,
+                ),
+                cache_key=json.dumps(
+                    [self._source, prompt, model, overflow_policy, compress]
+                    + [str(vars_in_scope.get(v)) for v in prompt_vars if v != name]
+                ),
+            )
+            return str(outputs)
+        return self._call(prompt, vars_in_scope, model, overflow_policy, compress)
 
-    def execute(self, prompt: str, vars_in_scope: Dict[str, Any]) -> Optional[str]:
+    def _call(
+        self,
+        prompt: str,
+        vars_in_scope: Dict[str, Any],
+        model: str,
+        overflow_policy: str = "reject",
+        compress: bool = False,
+        packed: bool = False,
+    ) -> Optional[str]:
+        if compress:
+            vars_in_scope = self.compress_vars(prompt, vars_in_scope)
         formatted_prompt = self.format_input(prompt, vars_in_scope)
-        if formatted_prompt:
-            return ai.llm.next([{"role": "user", "content": formatted_prompt}])
+        if not formatted_prompt:
+            return None
+        try:
+            if packed:
+                return ai.packing.next(
+                    formatted_prompt, instruction=prompt, model=model
+                )
+            return ai.llm.next(
+                [{"role": "user", "content": formatted_prompt}],
+                model=model,
+                instruction=prompt,
+            )
+        except ai.llm.PromptTooLong as e:
+            if overflow_policy not in ("truncate", "chunk"):
+                raise
+
+            # Fit the largest variable into what is left of the budget.
+            values = {
+                name: str(Stream.get(vars_in_scope[name]) or vars_in_scope[name])
+                for name in re.findall(r"{(\w+)}", prompt)
+                if name in vars_in_scope
+            }
+            if not values:
+                raise
+            name = max(values, key=lambda n: ai.llm.count_tokens(values[n]))
+            var_tokens = ai.llm.count_tokens(values[name])
+            budget = e.max_prompt_tokens - (e.prompt_tokens - var_tokens)
+            if budget <= 0:
+                raise
+            print(
+                f"Prompt of task :: {self._id} is too long. Applying {overflow_policy} to {{{name}}}."
+            )
+
+            if overflow_policy == "truncate":
+                truncated = ai.llm.truncate(values[name], budget)
+                return self._call(prompt, {**vars_in_scope, name: truncated}, model)
+            outputs = self.map_items(
+                ai.llm.split(values[name], budget),
+                lambda chunk: self._call(prompt, {**vars_in_scope, name: chunk}, model),
+            )
+            return "\n\n".join(o for o in outputs if o)
 
 
 class CodeTask(TaskComponent):
     name = "Code Task"
+    MAX_CANDIDATES = 5
+    CANDIDATE_TIMEOUT = 60
+    PROFILE_DIR = os.path.join(".cache", "profiles")
+    MAX_PROFILES = 32
+    # hash of (script, output) -> (summary, .prof path)
+    _profiles: "OrderedDict[str, Tuple[str, str]]" = OrderedDict()
+    _profiles_lock = threading.Lock()
 
     def __init__(
         self, id_: int, value: str = "", visible: bool = False, code_value: str = ""
@@ -133,7 +470,16 @@ class CodeTask(TaskComponent):
                         value=self._initial_code_value,
                         lines=3,
                     )
-                    generate_code = gr.Button("Generate code")
+                    with gr.Row():
+                        self.n_candidates = gr.Slider(
+                            1,
+                            self.MAX_CANDIDATES,
+                            value=1,
+                            step=1,
+                            label="Candidates (the fastest passing one is picked)",
+                            interactive=True,
+                        )
+                        generate_code = gr.Button("Generate code")
                     with gr.Accordion(label="Generated code", open=False) as accordion:
                         self.accordion = accordion
                         self.raw_output = gr.Textbox(
@@ -150,13 +496,38 @@ class CodeTask(TaskComponent):
                             lines=10,
                             interactive=True,
                         )
+                        self.candidates = gr.Textbox(
+                            label="Candidates",
+                            lines=3,
+                            interactive=False,
+                        )
                         self.error_message = gr.HighlightedText(
                             value=None, visible=False
                         )
+                        self.profile = gr.Checkbox(
+                            label="Profile this run",
+                            info="Runs once per element are profiled in every worker thread.",
+                            interactive=True,
+                        )
+                        with gr.Row():
+                            show_profile = gr.Button("Show last profile")
+                            optimize_code = gr.Button("Regenerate a faster version")
+                        self.profile_summary = gr.Textbox(
+                            label="Profile",
+                            lines=10,
+                            interactive=False,
+                        )
+                        self.profile_file = gr.File(
+                            label="Profile data (.prof)", interactive=False
+                        )
 
                     self.input = gr.Textbox(
                         label="Input", interactive=True, value=self._initial_value
                     )
+                    self.map_input = gr.Checkbox(
+                        label="Run once per element of a list variable",
+                        interactive=True,
+                    )
                 with gr.Column():
                     self.output = gr.Textbox(
                         label=f"Output: {{{self.vname}{self._id}}}",
@@ -166,25 +537,76 @@ class CodeTask(TaskComponent):
 
             generate_code.click(
                 self.generate_code,
-                inputs=[self.code_prompt],
+                inputs=[self.code_prompt, self.n_candidates, self.input],
+                outputs=[
+                    self.raw_output,
+                    self.packages,
+                    self.script,
+                    self.error_message,
+                    self.accordion,
+                    self.candidates,
+                ],
+            )
+            show_profile.click(
+                self.show_profile,
+                inputs=[self.script, self.output],
+                outputs=[self.profile_summary, self.profile_file],
+            )
+            optimize_code.click(
+                self.optimize_code,
+                inputs=[self.code_prompt, self.script, self.profile_summary],
                 outputs=[
                     self.raw_output,
                     self.packages,
                     self.script,
                     self.error_message,
                     self.accordion,
+                    self.candidates,
                 ],
             )
 
         return gr_component
 
+    @classmethod
+    def show_profile(cls, script: str, output: str):
+        """Profile of the run of script that produced output, if it was profiled."""
+        with cls._profiles_lock:
+            return cls._profiles.get(cls._profile_key(script, output), ("", None))
+
+    @staticmethod
+    def _profile_key(script: str, output: Any) -> str:
+        return hashlib.sha256(f"{script.strip()}\0{output}".encode()).hexdigest()
+
+    @staticmethod
+    def optimize_code(code_prompt: str, script: str, profile_summary: str):
+        if not script or not profile_summary:
+            return CodeTask.generate_code(code_prompt)
+        return CodeTask.generate_code(
+            code_prompt,
+            feedback=f"""Here is a previous version of the function:
+{script}
+
+Here is a profile of one of its runs:
+{profile_summary}
+
+Write a faster version of the function.""",
+        )
+
     @staticmethod
-    def generate_code(code_prompt: str):
+    def generate_code(
+        code_prompt: str, n_candidates: int = 1, input: str = "", feedback: str = ""
+    ):
+        """
+        With more than one candidate, candidates are generated in parallel and run in
+        a sandbox against input. The fastest one whose output is non-empty and agrees
+        with the majority is picked.
+        """
         raw_output = ""
         packages = ""
         script = ""
         error_message = gr.HighlightedText.update(None, visible=False)
         accordion = gr.Accordion.update()
+        candidates_report = ""
 
         if not code_prompt:
             return (
@@ -193,28 +615,79 @@ class CodeTask(TaskComponent):
                 script,
                 error_message,
                 accordion,
+                candidates_report,
             )
 
-        def llm_call(prompt):
-            return ai.llm.next([{"role": "user", "content": prompt}], temperature=0)
-
         print(f"Generating code.")
         try:
-            raw_output = llm_call(
-                f"""Write a python function to:
+            n_candidates = int(n_candidates or 1)
+            if n_candidates == 1:
+                raw_output, packages, script = CodeTask._generate_candidate(
+                    code_prompt, feedback, temperature=0
+                )
+            else:
+                with ThreadPoolExecutor(n_candidates) as executor:
+                    candidates = list(
+                        executor.map(
+                            lambda i: CodeTask._generate_candidate(
+                                code_prompt,
+                                feedback,
+                                # The first candidate is the one a single generation gets.
+                                temperature=0 if i == 0 else ai.llm.TEMPERATURE,
+                            ),
+                            range(n_candidates),
+                        )
+                    )
+                best, candidates_report = CodeTask._select_candidate(candidates, input)
+                raw_output, packages, script = candidates[best]
+        except Exception as e:
+            traceback.print_exc()
+            error_message = gr.HighlightedText.update(
+                value=[(str(e), "ERROR")], visible=True
+            )
+            accordion = gr.Accordion.update(open=True)
+        return (
+            raw_output,
+            packages,
+            script,
+            error_message,
+            accordion,
+            candidates_report,
+        )
+
+    @staticmethod
+    def _generate_candidate(
+        code_prompt: str, feedback: str, temperature: float
+    ) -> Tuple[str, Any, str]:
+        def llm_call(prompt, temperature=0):
+            # Candidates must not be coalesced into the same request.
+            return ai.llm.next(
+                [{"role": "user", "content": prompt}],
+                temperature=temperature,
+                coalesce=temperature == 0,
+            )
+
+        raw_output = llm_call(
+            f"""Write a python function to:
                 {code_prompt}
 
+{feedback}
 Write the code for the function. Name the function toolkit.
 Use pip packages where available.
+To make HTTP GET requests, use the function fetch(url, params=None, headers=None). It is already defined, don't import it.
+It works like requests.get and returns a requests.Response. It already sends the correct headers.
 Include the necessary imports.
-Instead of printing or saving to disk, the function should return the data."""
-            )
-            with ThreadPoolExecutor() as executor:
-                packages, script = tuple(
-                    executor.map(
-                        llm_call,
-                        [
-                            f"""The following text has some python code:
+Instead of printing or saving to disk, the function should return the data.
+If the function processes a list of items one by one, make it a generator that yields each result.""",
+            # Only the code varies between candidates. Extraction is deterministic.
+            temperature,
+        )
+        with ThreadPoolExecutor() as executor:
+            packages, script = tuple(
+                executor.map(
+                    llm_call,
+                    [
+                        f"""The following text has some python code:
 {raw_output}
 
 Find the pip packages that need to be installed and get their corresponsing names in pip.
@@ -227,67 +700,183 @@ Put them in a valid JSON:
     "packages": List of packages. If no packages, empty list.
 }}
 ```""",
-                            f"""The following text has some python code:
+                        f"""The following text has some python code:
 {raw_output}
 
 Extract it. Remove anything after the function definition.""",
-                        ],
-                    )
+                    ],
                 )
-            for packages in re.findall("{.*}", packages, re.DOTALL):
-                try:
-                    packages = json.loads(packages)
-                    packages = packages["packages"]
-                except:
-                    print(packages)
-                    traceback.print_exc()
-                    packages = "ERROR"
-        except Exception as e:
-            traceback.print_exc()
-            error_message = gr.HighlightedText.update(
-                value=[(str(e), "ERROR")], visible=True
             )
-            accordion = gr.Accordion.update(open=True)
+        for packages in re.findall("{.*}", packages, re.DOTALL):
+            try:
+                packages = json.loads(packages)
+                packages = packages["packages"]
+            except:
+                print(packages)
+                traceback.print_exc()
+                packages = "ERROR"
         return (
             raw_output,
             packages,
             script.replace("```python", "").replace("```", "").strip(),
-            error_message,
-            accordion,
         )
 
+    @staticmethod
+    def _select_candidate(
+        candidates: List[Tuple[str, Any, str]], input: str
+    ) -> Tuple[int, str]:
+        if re.search(r"{\w+}", input):
+            # Variables can't be resolved outside of a pipeline execution.
+            return 0, "Candidates were not compared: the input uses variables."
+
+        # Installed one at a time, before candidates run in parallel.
+        packages = {p for _, ps, _ in candidates if isinstance(ps, list) for p in ps}
+        for p in sorted(packages):
+            try:
+                subprocess.check_call(
+                    [sys.executable, "-m", "pip", "install", p],
+                    timeout=CodeTask.CANDIDATE_TIMEOUT,
+                )
+            except Exception:
+                traceback.print_exc()
+
+        with ThreadPoolExecutor(len(candidates)) as executor:
+            results = list(
+                executor.map(
+                    lambda candidate: CodeTask._run_candidate(candidate[2], input),
+                    candidates,
+                )
+            )
+
+        passing = [i for i, r in enumerate(results) if r.get("output")]
+        best = 0
+        if passing:
+            votes: Dict[str, int] = {}
+            for i in passing:
+                votes[results[i]["output"]] = votes.get(results[i]["output"], 0) + 1
+            majority = max(votes.values())
+            best = min(
+                (i for i in passing if votes[results[i]["output"]] == majority),
+                key=lambda i: results[i]["seconds"],
+            )
+
+        report = []
+        for i, result in enumerate(results):
+            if "error" in result:
+                line = f"Candidate {i + 1}: {result['error']}"
+            else:
+                line = (
+                    f"Candidate {i + 1}: {result['seconds']:.2f}s, "
+                    f"{result['peak'] / 2**20:.1f} MiB peak, "
+                    f"{len(result['output'])} characters of output"
+                )
+            report.append(line + (" <- selected" if i == best else ""))
+        if not passing:
+            report.append("No candidate passed. Using the first one.")
+        return best, "\n".join(report)
+
+    @staticmethod
+    def _run_candidate(script: str, input: str) -> Dict[str, Any]:
+        try:
+            completed = subprocess.run(
+                [sys.executable, sandbox.__file__],
+                input=json.dumps({"script": script, "input": input}),
+                capture_output=True,
+                text=True,
+                timeout=CodeTask.CANDIDATE_TIMEOUT,
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+            )
+        except subprocess.TimeoutExpired:
+            return {"error": f"timed out after {CodeTask.CANDIDATE_TIMEOUT}s"}
+        except Exception as e:
+            return {"error": str(e)}
+
+        for line in reversed(completed.stdout.splitlines()):
+            if line.startswith(sandbox.RESULT_PREFIX):
+                return json.loads(line[len(sandbox.RESULT_PREFIX) :])
+        stderr = completed.stderr.strip().splitlines()
+        return {"error": stderr[-1] if stderr else "no output"}
+
     @property
     def inputs(self) -> List[gr.Textbox]:
-        return [self.packages, self.script, self.input]
+        return [self.packages, self.script, self.input, self.map_input, self.profile]
+
+    @property
+    def initial_inputs(self) -> List[Any]:
+        # Packages and script come from generate_code.
+        return ["", "", self._initial_value, False, False]
+
+    @property
+    def initial_code_prompt(self) -> str:
+        return self._initial_code_value
 
     def execute(
-        self, packages: str, script: str, input: str, vars_in_scope: Dict[str, Any]
+        self,
+        packages: str,
+        script: str,
+        input: str,
+        map_input: bool,
+        profile: bool,
+        vars_in_scope: Dict[str, Any],
     ):
         if not script:
             return None
         script = script.strip()
 
-        formatted_input = self.format_input(input, vars_in_scope)
+        # A stream passed as the whole input is handed over lazily.
+        input_stream = self.stream_vars(input, vars_in_scope).get(input.strip()[1:-1])
+        formatted_input = (
+            None
+            if input_stream or map_input
+            else self.format_input(input, vars_in_scope)
+        )
 
-        import inspect
         import subprocess
         import sys
 
-        def run(toolkit_func):
+        def run(toolkit_func, element_func=None):
             if len(inspect.getfullargspec(toolkit_func)[0]) > 0:
-                if formatted_input:
+                if map_input:
+                    _, items = self.list_var(input, vars_in_scope)
+                    return str(
+                        self.map_elements(
+                            items,
+                            element_func or toolkit_func,
+                            cache_key=f"{self._source}\0{script}",
+                        )
+                    )
+                if input_stream:
+                    output = toolkit_func(input_stream)
+                elif formatted_input:
                     try:
-                        return toolkit_func(eval(formatted_input))
+                        output = toolkit_func(eval(formatted_input))
                     except:
-                        return toolkit_func(formatted_input)
-                raise ValueError(f"Code for task :: {self._id} needs an input.")
-            return toolkit_func()
+                        output = toolkit_func(formatted_input)
+                else:
+                    raise ValueError(f"Code for task :: {self._id} needs an input.")
+            else:
+                output = toolkit_func()
+            if inspect.isgenerator(output):
+                # Generators are drained in place when profiling, so the work is measured.
+                return list(output) if profile else Stream(output).key
+            return output
 
+        timings = {}
+        start = time.perf_counter()
         for p in eval(packages):
             subprocess.check_call([sys.executable, "-m", "pip", "install", p])
+        timings["pip install"] = time.perf_counter() - start
+
+        # Helpers available to the generated code.
+        fetch = web.fetch
+
+        if profile:
+            run = self._profiled(run, timings, script, per_element=map_input)
 
         script = f"import os\nos.environ = {{}}\n\n{script}"
+        start = time.perf_counter()
         exec(script, locals())
+        timings["exec"] = time.perf_counter() - start
 
         locals_ = locals()
         if "toolkit" in locals_:
@@ -295,13 +884,95 @@ Extract it. Remove anything after the function definition.""",
             return run(toolkit_func)
         for var in reversed(locals_.values()):
             # Try to run all local functions
-            if callable(var):
+            if callable(var) and var is not fetch:
                 try:
                     return run(var)
                 except:
                     continue
         raise RuntimeError(f"Unable to run the code for task :: {self._id}")
 
+    def _profiled(
+        self,
+        run: Callable[..., Any],
+        timings: Dict[str, float],
+        script: str,
+        per_element: bool = False,
+    ) -> Callable[[Callable], Any]:
+        """
+        Wraps run with cProfile and tracemalloc. The summary and the .prof file of the
+        run are kept by script and output, for show_profile.
+        Runs once per element happen in worker threads, so each element gets its own
+        profiler and their stats are merged.
+        """
+
+        def profiled_run(toolkit_func):
+            profilers = []
+            profilers_lock = threading.Lock()
+
+            def profiled_element(item):
+                profiler = cProfile.Profile()
+                with profilers_lock:
+                    profilers.append(profiler)
+                return profiler.runcall(toolkit_func, item)
+
+            # tracemalloc is process wide. Don't interfere with another traced run.
+            trace_memory = not tracemalloc.is_tracing()
+            if trace_memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            output = None
+            try:
+                if per_element:
+                    output = run(toolkit_func, profiled_element)
+                else:
+                    profiler = cProfile.Profile()
+                    profilers.append(profiler)
+                    output = profiler.runcall(run, toolkit_func)
+                return output
+            finally:
+                timings["run"] = time.perf_counter() - start
+                summary = [f"{k}: {v:.2f}s" for k, v in timings.items()]
+                if trace_memory:
+                    snapshot = tracemalloc.take_snapshot()
+                    _, peak = tracemalloc.get_traced_memory()
+                    tracemalloc.stop()
+                    summary.append(f"peak memory: {peak / 2**20:.1f} MiB")
+
+                if profilers:
+                    stats_output = io.StringIO()
+                    stats = pstats.Stats(*profilers, stream=stats_output)
+                    stats.sort_stats("cumulative").print_stats(15)
+                    summary += ["", "Top functions by cumulative time:"]
+                    summary.append(stats_output.getvalue().strip())
+                if trace_memory:
+                    summary += ["", "Top allocation sites:"]
+                    summary += [
+                        str(stat) for stat in snapshot.statistics("lineno")[:10]
+                    ]
+
+                if profilers and output is not None:
+                    key = self._profile_key(script, output)
+                    os.makedirs(self.PROFILE_DIR, exist_ok=True)
+                    prof_path = os.path.join(self.PROFILE_DIR, f"{key}.prof")
+                    stats.dump_stats(prof_path)
+                    self._store_profile(key, "\n".join(summary), prof_path)
+
+        return profiled_run
+
+    @classmethod
+    def _store_profile(cls, key: str, summary: str, prof_path: str) -> None:
+        with cls._profiles_lock:
+            cls._profiles[key] = (summary, prof_path)
+            cls._profiles.move_to_end(key)
+            evicted = []
+            while len(cls._profiles) > cls.MAX_PROFILES:
+                evicted.append(cls._profiles.popitem(last=False)[1][1])
+        for path in evicted:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
 
 class Task(Component):
     available_tasks = [AITask, CodeTask]
@@ -1,52 +1,180 @@
-from typing import List
+import functools
+import json
+import re
+from typing import Any, Dict, List, Optional, Tuple
 import gradio as gr
 
-from components import CodeTask, Task, TaskComponent
+import journal
+from components import CodeTask, Stream, Task, TaskComponent
 
 
 def demo_buttons(demo_id, tasks: List[TaskComponent]):
     error_message = gr.HighlightedText(value=None, visible=False)
-    execute_btn = gr.Button("Generate code and execute tasks")
+    run_id = gr.Textbox(visible=False)
+    resume = gr.Checkbox(visible=False)
+    served = gr.Checkbox(visible=False)
+    with gr.Row():
+        execute_btn = gr.Button("Execute tasks")
+        live_btn = gr.Button("Re-run live")
+        resume_btn = gr.Button("Resume from the first failed or changed task")
 
-    # Sequential execution
-    execution_event = execute_btn.click(
-        # Clear error message
-        lambda: gr.HighlightedText.update(value=None, visible=False),
-        inputs=[],
-        outputs=[error_message],
-    )
-    prev_tasks = []
+    # Snapshots are only served for the initial values of the example.
+    snapshot_inputs = []
     for task in tasks:
         if isinstance(task, CodeTask):
+            # Packages and script are generated.
+            snapshot_inputs += [task.code_prompt] + task.inputs[2:]
+        else:
+            snapshot_inputs += task.inputs
+
+    snapshot_outputs = []
+    for task in tasks:
+        if isinstance(task, CodeTask):
+            snapshot_outputs += [
+                task.raw_output,
+                task.packages,
+                task.script,
+                task.candidates,
+            ]
+        snapshot_outputs.append(task.output)
+
+    # Sequential execution
+    for btn, first_step, first_inputs, first_outputs in [
+        # Serves the latest snapshot, if any. Otherwise, runs live.
+        (
+            execute_btn,
+            functools.partial(serve_snapshot, tasks),
+            [demo_id] + snapshot_inputs,
+            [error_message, run_id, resume, served] + snapshot_outputs,
+        ),
+        (
+            live_btn,
+            functools.partial(start_run, False),
+            [demo_id],
+            [error_message, run_id, resume, served],
+        ),
+        (
+            resume_btn,
+            functools.partial(start_run, True),
+            [demo_id],
+            [error_message, run_id, resume, served],
+        ),
+    ]:
+        execution_event = btn.click(
+            # Clear error message and start a new journal run
+            first_step,
+            inputs=first_inputs,
+            outputs=first_outputs,
+        )
+        prev_tasks = []
+        for task in tasks:
+            if isinstance(task, CodeTask):
+                execution_event = execution_event.then(
+                    generate_code,
+                    inputs=[
+                        demo_id,
+                        task.component_id,
+                        task.code_prompt,
+                        task.n_candidates,
+                        task.input,
+                        error_message,
+                        run_id,
+                        resume,
+                        served,
+                    ]
+                    + [t.output for t in prev_tasks],
+                    outputs=[
+                        task.raw_output,
+                        task.packages,
+                        task.script,
+                        task.error_message,
+                        task.accordion,
+                        task.candidates,
+                    ],
+                )
             execution_event = execution_event.then(
-                generate_code,
-                inputs=[task.code_prompt, error_message],
-                outputs=[
-                    task.raw_output,
-                    task.packages,
-                    task.script,
-                    task.error_message,
-                    task.accordion,
-                ],
+                execute_task,
+                inputs=[
+                    demo_id,
+                    task.component_id,
+                    error_message,
+                    run_id,
+                    resume,
+                    served,
+                ]
+                + task.inputs
+                + [t.output for t in prev_tasks],
+                outputs=[task.output, error_message],
             )
-        execution_event = execution_event.then(
-            execute_task,
-            inputs=[demo_id, task.component_id, error_message]
-            + task.inputs
-            + [t.output for t in prev_tasks],
-            outputs=[task.output, error_message],
-        )
-        prev_tasks.append(task)
+            # Streamed outputs are filled in when they finish, without blocking the
+            # next tasks.
+            execution_event.then(
+                materialize_output,
+                inputs=[task.component_id, task.output],
+                outputs=[task.output, error_message],
+            )
+            prev_tasks.append(task)
 
 
 demo_tasks = {}
 
 
-def execute_task(demo_id: str, task_id: int, error_value, *args):
+def start_run(resume: bool, demo_id: str):
+    return (
+        gr.HighlightedText.update(value=None, visible=False),
+        journal.start_run(demo_id),
+        resume,
+        False,
+    )
+
+
+def serve_snapshot(tasks: List[TaskComponent], demo_id: str, *current_inputs):
+    import snapshots
+
+    initial_inputs = []
+    for task in tasks:
+        if isinstance(task, CodeTask):
+            initial_inputs += [task.initial_code_prompt] + task.initial_inputs[2:]
+        else:
+            initial_inputs += task.initial_inputs
+
+    snapshot = None
+    # Edited examples run live.
+    if list(current_inputs) == initial_inputs:
+        snapshot = snapshots.load(demo_id)
+    if not snapshot:
+        n_outputs = sum(5 if isinstance(t, CodeTask) else 1 for t in tasks)
+        return list(start_run(False, demo_id)) + [gr.update()] * n_outputs
+
+    print(f"Serving a snapshot of {demo_id}.")
+    outputs = [
+        gr.HighlightedText.update(value=None, visible=False),
+        "",
+        False,
+        True,
+    ]
+    for task, task_snapshot in zip(tasks, snapshot["tasks"]):
+        if isinstance(task, CodeTask):
+            outputs += task_snapshot["code"]
+        outputs.append(task_snapshot["output"])
+    return outputs
+
+
+def execute_task(
+    demo_id: str,
+    task_id: int,
+    error_value,
+    run_id: str,
+    resume: bool,
+    served: bool,
+    *args,
+):
     error_update = gr.HighlightedText.update(
         value=error_value, visible=error_value is not None
     )
 
+    if served:
+        return [gr.update(), error_update]
     if error_value:
         return ["", error_update]
 
@@ -60,13 +188,9 @@ def execute_task(demo_id: str, task_id: int, error_value, *args):
     if not non_empty_inputs:
         return ["", error_update]
 
-    # Put task outputs in a dictionary with names.
-    vars_in_scope = {f"{Task.vname}{i}": o for i, o in enumerate(prev_task_outputs)}
-
     try:
-        # Task logic gets inserted into the right index
-        output = demo_tasks[demo_id][task_id].execute(
-            *task_inputs, vars_in_scope=vars_in_scope
+        output = _execute(
+            demo_id, task_id, task_inputs, prev_task_outputs, run_id, resume
         )
         return [output, error_update]
     except Exception as e:
@@ -82,6 +206,157 @@ def execute_task(demo_id: str, task_id: int, error_value, *args):
         ]
 
 
-def generate_code(code_prompt: str, error_value):
+def materialize_output(task_id: int, output):
+    """Replaces a streamed output with its items once the stream finishes."""
+    try:
+        if not Stream.get(output):
+            return [gr.update(), gr.update()]
+        return [Stream.materialize(output), gr.update()]
+    except Exception as e:
+        return [
+            "ERROR",
+            gr.HighlightedText.update(
+                value=[(f"Error in Task {int(task_id)} :: {e}", "ERROR")],
+                visible=True,
+            ),
+        ]
+
+
+def _execute(
+    demo_id: str,
+    task_id: int,
+    task_inputs: List[Any],
+    prev_task_outputs: List[Any],
+    run_id: str,
+    resume: bool,
+    materialize: bool = False,
+) -> Any:
+    # Put task outputs in a dictionary with names.
+    vars_in_scope = {f"{Task.vname}{i}": o for i, o in enumerate(prev_task_outputs)}
+    # Only variables used by the task make it to the journal key.
+    used_vars = set(re.findall(r"{(\w+)}", " ".join(str(i) for i in task_inputs)))
+
+    return journal.run_step(
+        run_id,
+        demo_id,
+        str(task_id),
+        [list(task_inputs)] + [vars_in_scope.get(v) for v in sorted(used_vars)],
+        lambda: demo_tasks[demo_id][task_id].execute(
+            *task_inputs, vars_in_scope=vars_in_scope
+        ),
+        resume=resume,
+        materialize=materialize,
+    )
+
+
+def generate_code(
+    demo_id: str,
+    task_id: int,
+    code_prompt: str,
+    n_candidates: int,
+    input: str,
+    error_value,
+    run_id: str,
+    resume: bool,
+    served: bool,
+    *prev_task_outputs,
+):
+    if served:
+        return tuple(gr.update() for _ in range(6))
     if not error_value and code_prompt:
-        return CodeTask.generate_code(code_prompt)
+        task_id = int(task_id)
+        vars_in_scope = {f"{Task.vname}{i}": o for i, o in enumerate(prev_task_outputs)}
+        try:
+            # Candidates are compared on the actual input of the task.
+            input = demo_tasks[demo_id][task_id].format_input(input, vars_in_scope)
+        except Exception:
+            pass
+        try:
+            raw_output, packages, script, candidates_report = _generate_code(
+                demo_id, task_id, code_prompt, run_id, resume, n_candidates, input
+            )
+        except Exception as e:
+            return (
+                "",
+                "",
+                "",
+                gr.HighlightedText.update(value=[(str(e), "ERROR")], visible=True),
+                gr.Accordion.update(open=True),
+                "",
+            )
+        return (
+            raw_output,
+            packages,
+            script,
+            gr.HighlightedText.update(None, visible=False),
+            gr.Accordion.update(),
+            candidates_report,
+        )
+
+
+def _generate_code(
+    demo_id: str,
+    task_id: int,
+    code_prompt: str,
+    run_id: str,
+    resume: bool,
+    n_candidates: int = 1,
+    input: str = "",
+) -> Tuple[str, Any, str, str]:
+    def generate() -> str:
+        (
+            raw_output,
+            packages,
+            script,
+            error_message,
+            _,
+            candidates_report,
+        ) = CodeTask.generate_code(code_prompt, n_candidates, input)
+        if error_message["visible"]:
+            raise RuntimeError(error_message["value"][0][0])
+        return json.dumps([raw_output, packages, script, candidates_report])
+
+    n_candidates = int(n_candidates or 1)
+    return tuple(
+        json.loads(
+            journal.run_step(
+                run_id,
+                demo_id,
+                f"{task_id}/code",
+                [code_prompt] + ([n_candidates, input] if n_candidates > 1 else []),
+                generate,
+                resume=resume,
+            )
+        )
+    )
+
+
+def run_headless(
+    demo_id: str,
+    resume: bool = True,
+    generated_code: Optional[Dict[int, Tuple[str, Any, str, str]]] = None,
+) -> List[Any]:
+    """
+    Runs an example pipeline without the UI, with the initial values of its tasks.
+    Every step is journaled, so with resume a crashed or failed run continues from
+    the first failed or changed step.
+    The code generated for Code tasks is put in generated_code, if given.
+    Streamed outputs are returned materialized.
+    """
+    run_id = journal.start_run(demo_id)
+    outputs = []
+    for task_id, task in enumerate(demo_tasks[demo_id]):
+        task_inputs = task.initial_inputs
+        if isinstance(task, CodeTask):
+            code = _generate_code(
+                demo_id, task_id, task.initial_code_prompt, run_id, resume
+            )
+            if generated_code is not None:
+                generated_code[task_id] = code
+            task_inputs[:2] = [str(code[1]), code[2]]
+        print(f"Executing task :: {task_id} of {demo_id}")
+        # Nothing to overlap without the UI, so streams are materialized right away.
+        outputs.append(
+            _execute(demo_id, task_id, task_inputs, outputs, run_id, resume, True)
+        )
+    return outputs
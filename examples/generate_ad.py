@@ -31,7 +31,7 @@ Avoid logos.""",
         code_value="Use openai to generate an image from a prompt. Use they key {your_key}. Return the url.",
     ),
     AITask(
-        1,
+        3,
         """Here is the text from a website:
 {t0}
 
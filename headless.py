@@ -0,0 +1,37 @@
+import argparse
+
+from examples import (
+    authenticate_google,
+    best_clubs,
+    generate_ad,
+    run_headless,
+    seo,
+    summarize_website,
+)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run an example pipeline without UI.")
+    parser.add_argument(
+        "example",
+        choices=[
+            m.__name__.split(".")[-1]
+            for m in [
+                authenticate_google,
+                best_clubs,
+                generate_ad,
+                seo,
+                summarize_website,
+            ]
+        ],
+    )
+    parser.add_argument(
+        "--no-resume",
+        action="store_true",
+        help="Execute every task, even if a journaled output can be reused.",
+    )
+    args = parser.parse_args()
+
+    outputs = run_headless(f"examples.{args.example}", resume=not args.no_resume)
+    for i, output in enumerate(outputs):
+        print(f"\n{{t{i}}}:\n{output}")
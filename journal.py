@@ -0,0 +1,197 @@
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Callable, Iterator, List, Optional, Tuple
+
+from components import Stream
+
+
+DB_PATH = os.environ.get("JOURNAL_PATH", os.path.join(".cache", "journal.sqlite3"))
+BLOB_DIR = os.path.join(os.path.dirname(DB_PATH), "journal_blobs")
+# Outputs larger than this are stored as files and referenced from the db.
+MAX_INLINE_OUTPUT = 64 * 1024
+BLOB_PREFIX = "blob:"
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id TEXT PRIMARY KEY,
+    pipeline TEXT NOT NULL,
+    started REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS steps (
+    run_id TEXT NOT NULL REFERENCES runs(id),
+    step TEXT NOT NULL,
+    inputs_hash TEXT NOT NULL,
+    status TEXT NOT NULL,
+    output TEXT,
+    error TEXT,
+    started REAL NOT NULL,
+    seconds REAL NOT NULL,
+    PRIMARY KEY (run_id, step)
+);
+CREATE INDEX IF NOT EXISTS steps_by_inputs ON steps(step, inputs_hash);
+"""
+
+_schema_created = False
+_schema_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _connect() -> Iterator[sqlite3.Connection]:
+    """Commits on success and closes the connection."""
+    global _schema_created
+    os.makedirs(os.path.dirname(DB_PATH) or ".", exist_ok=True)
+    with contextlib.closing(sqlite3.connect(DB_PATH, timeout=30)) as connection:
+        with _schema_lock:
+            if not _schema_created:
+                connection.executescript(SCHEMA)
+                _schema_created = True
+        with connection:
+            yield connection
+
+
+def start_run(pipeline: str) -> str:
+    run_id = uuid.uuid4().hex
+    with _connect() as connection:
+        connection.execute(
+            "INSERT INTO runs VALUES (?, ?, ?)", (run_id, pipeline, time.time())
+        )
+    return run_id
+
+
+def hash_inputs(inputs: Any) -> str:
+    return hashlib.sha256(json.dumps(inputs, default=str).encode()).hexdigest()
+
+
+def _record(
+    run_id: str,
+    step: str,
+    inputs_hash: str,
+    status: str,
+    started: float,
+    output: Optional[str] = None,
+    error: Optional[str] = None,
+) -> None:
+    if output is not None and len(output) > MAX_INLINE_OUTPUT:
+        blob_hash = hashlib.sha256(output.encode()).hexdigest()
+        os.makedirs(BLOB_DIR, exist_ok=True)
+        with open(os.path.join(BLOB_DIR, blob_hash), "w") as f:
+            f.write(output)
+        output = f"{BLOB_PREFIX}{blob_hash}"
+    with _connect() as connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO steps VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                run_id,
+                step,
+                inputs_hash,
+                status,
+                output,
+                error,
+                started,
+                time.time() - started,
+            ),
+        )
+
+
+def _find_output(pipeline: str, step: str, inputs_hash: str) -> Tuple[bool, Any]:
+    with _connect() as connection:
+        row = connection.execute(
+            """
+            SELECT steps.output FROM steps JOIN runs ON steps.run_id = runs.id
+            WHERE runs.pipeline = ? AND steps.step = ? AND steps.inputs_hash = ?
+                AND steps.status IN ('success', 'reused')
+            ORDER BY steps.started DESC LIMIT 1
+            """,
+            (pipeline, step, inputs_hash),
+        ).fetchone()
+    if row is None:
+        return False, None
+    output = row[0]
+    if output is not None and output.startswith(BLOB_PREFIX):
+        try:
+            with open(os.path.join(BLOB_DIR, output[len(BLOB_PREFIX) :])) as f:
+                output = f.read()
+        except OSError:
+            return False, None
+    return True, output
+
+
+def _materialize(value: Any) -> Any:
+    stream = Stream.get(value)
+    return str(stream) if stream else value
+
+
+def run_step(
+    run_id: str,
+    pipeline: str,
+    step: str,
+    inputs: List[Any],
+    func: Callable[[], Any],
+    resume: bool = False,
+    materialize: bool = False,
+) -> Any:
+    """
+    Runs func and journals its output, status and timing under run_id.
+    With resume, the latest successful output of the same step with the same inputs
+    is reused instead.
+    Streams are journaled by their items, in the background once they finish, so
+    downstream tasks aren't blocked. With materialize, a streamed output is
+    materialized before it is journaled and returned.
+    """
+    started = time.time()
+    streamed_inputs = any(Stream.get(i) for i in inputs)
+    # Steps with streamed inputs follow a step that ran again, so they run again too.
+    if resume and not streamed_inputs:
+        inputs_hash = hash_inputs(inputs)
+        found, output = _find_output(pipeline, step, inputs_hash)
+        if found:
+            print(f"Reusing the journaled output of step :: {step}")
+            _record(run_id, step, inputs_hash, "reused", started, output)
+            return output
+
+    def record(status: str, output: Any = None, error: Optional[str] = None) -> None:
+        try:
+            materialized_inputs = [_materialize(i) for i in inputs]
+        except Exception:
+            # A failed upstream stream. This step is never reused anyway.
+            materialized_inputs = inputs
+        try:
+            output = _materialize(output)
+        except Exception as e:
+            status, output, error = "failed", None, str(e)
+        _record(
+            run_id,
+            step,
+            hash_inputs(materialized_inputs),
+            status,
+            started,
+            None if output is None else str(output),
+            error,
+        )
+
+    def finish(status: str, output: Any = None, error: Optional[str] = None) -> None:
+        if streamed_inputs or Stream.get(output):
+            if Stream.get(output):
+                _record(run_id, step, hash_inputs(inputs), "streamed", started)
+            threading.Thread(
+                target=record, args=(status, output, error), daemon=True
+            ).start()
+        else:
+            record(status, output, error)
+
+    try:
+        output = func()
+        if materialize:
+            output = _materialize(output)
+    except Exception as e:
+        finish("failed", error=str(e))
+        raise
+    finish("success", output)
+    return output
@@ -0,0 +1,62 @@
+"""
+Runs a generated toolkit function in its own process, the same way CodeTask.execute
+does, and reports its output, runtime and peak memory.
+Reads {"script": ..., "input": ...} as JSON from stdin.
+"""
+import inspect
+import json
+import resource
+import sys
+import time
+
+from web import fetch
+
+RESULT_PREFIX = "__sandbox_result__"
+
+
+def peak_memory() -> int:
+    """
+    Peak resident memory of this process, in bytes. Unlike tracemalloc, measuring it
+    doesn't slow the run down.
+    """
+    # ru_maxrss survives exec, so it would include the memory of the parent process.
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def main() -> None:
+    request = json.load(sys.stdin)
+    namespace = {"fetch": fetch}
+    exec(f"import os\nos.environ = {{}}\n\n{request['script']}", namespace)
+    toolkit_func = namespace.get("toolkit")
+    if not callable(toolkit_func):
+        raise RuntimeError("The code doesn't define a toolkit function.")
+
+    input = request["input"]
+    start = time.perf_counter()
+    if len(inspect.getfullargspec(toolkit_func)[0]) > 0:
+        try:
+            output = toolkit_func(eval(input))
+        except:
+            output = toolkit_func(input)
+    else:
+        output = toolkit_func()
+    if inspect.isgenerator(output):
+        output = list(output)
+    seconds = time.perf_counter() - start
+    peak = peak_memory()
+
+    print(
+        RESULT_PREFIX
+        + json.dumps({"output": str(output), "seconds": seconds, "peak": peak})
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+import traceback
+from typing import Any, Dict, Optional
+
+from components import CodeTask, Stream
+from examples import demo_tasks, run_headless
+
+
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", os.path.join(".cache", "snapshots"))
+REFRESH_SECONDS = float(os.environ.get("SNAPSHOT_REFRESH_SECONDS", 6 * 60 * 60))
+WARM_UP = os.environ.get("SNAPSHOT_WARM_UP", "1") == "1"
+
+
+def version(demo_id: str) -> str:
+    """Changes whenever the definition of the example changes."""
+    definition = [
+        [
+            task.__class__.__name__,
+            task.initial_inputs,
+            task.initial_code_prompt if isinstance(task, CodeTask) else None,
+        ]
+        for task in demo_tasks[demo_id]
+    ]
+    return hashlib.sha256(json.dumps(definition).encode()).hexdigest()[:16]
+
+
+def _path(demo_id: str) -> str:
+    return os.path.join(SNAPSHOT_DIR, f"{demo_id}-{version(demo_id)}.json")
+
+
+def load(demo_id: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(_path(demo_id)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def warm(demo_id: str, resume: bool = True) -> Dict[str, Any]:
+    """Runs an example pipeline and stores its generated code and outputs."""
+    generated_code: Dict[int, Any] = {}
+    outputs = run_headless(demo_id, resume=resume, generated_code=generated_code)
+    snapshot = {
+        "version": version(demo_id),
+        "time": time.time(),
+        "tasks": [
+            {
+                # Streams only live in this process.
+                "output": str(Stream.get(output) or output),
+                "code": generated_code.get(task_id),
+            }
+            for task_id, output in enumerate(outputs)
+        ],
+    }
+
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    path = _path(demo_id)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_path, path)
+    # Snapshots of older definitions are never served again.
+    for old_path in glob.glob(os.path.join(SNAPSHOT_DIR, f"{demo_id}-*.json")):
+        if old_path != path:
+            os.remove(old_path)
+    print(f"Stored a snapshot of {demo_id}.")
+    return snapshot
+
+
+def warm_all(max_age: float) -> None:
+    for demo_id in list(demo_tasks):
+        snapshot = load(demo_id)
+        if snapshot and time.time() - snapshot["time"] < max_age:
+            continue
+        try:
+            # A first snapshot can reuse the journal. Refreshes run live.
+            warm(demo_id, resume=snapshot is None)
+        except Exception:
+            print(f"Unable to take a snapshot of {demo_id}.")
+            traceback.print_exc()
+
+
+def start_warmer() -> None:
+    """Takes missing snapshots in the background and refreshes them periodically."""
+    if not WARM_UP:
+        return
+
+    def loop():
+        while True:
+            warm_all(REFRESH_SECONDS)
+            time.sleep(REFRESH_SECONDS)
+
+    threading.Thread(target=loop, daemon=True).start()
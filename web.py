@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+
+CACHE_DIR = os.environ.get("FETCH_CACHE_DIR", os.path.join(".cache", "fetch"))
+CACHE_TTL = float(os.environ.get("FETCH_CACHE_TTL", 60 * 60))
+MAX_CONCURRENCY = int(os.environ.get("FETCH_MAX_CONCURRENCY", 8))
+TIMEOUT = 30
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "en-US,en;q=0.9",
+}
+
+session = requests.Session()
+session.headers.update(HEADERS)
+_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=MAX_CONCURRENCY)
+session.mount("http://", _adapter)
+session.mount("https://", _adapter)
+_semaphore = threading.BoundedSemaphore(MAX_CONCURRENCY)
+
+
+def fetch(
+    url: str,
+    params: Optional[Dict[str, Any]] = None,
+    headers: Optional[Dict[str, str]] = None,
+    ttl: Optional[float] = None,
+    timeout: Optional[float] = TIMEOUT,
+    **kwargs,
+) -> requests.Response:
+    """
+    GET a url through a shared, pooled session.
+    Responses are cached on disk. Cached responses younger than ttl are served without
+    touching the network, older ones are revalidated with ETag/Last-Modified.
+    Other keyword arguments of requests.get are passed through. Requests that use any,
+    like auth, cookies or allow_redirects=False, bypass the cache.
+    """
+    if ttl is None:
+        ttl = CACHE_TTL
+    headers = headers or {}
+    full_url = requests.Request("GET", url, params=params).prepare().url
+    if kwargs.get("allow_redirects", True):
+        kwargs.pop("allow_redirects", None)
+    if kwargs:
+        with _semaphore:
+            return session.get(full_url, headers=headers, timeout=timeout, **kwargs)
+
+    key = hashlib.sha256(
+        json.dumps([full_url, sorted(headers.items())]).encode()
+    ).hexdigest()
+
+    cached = _load(key)
+    if cached and time.time() - cached["time"] < ttl:
+        return _to_response(cached)
+
+    conditional_headers = {}
+    if cached and "ETag" in cached["headers"]:
+        conditional_headers["If-None-Match"] = cached["headers"]["ETag"]
+    if cached and "Last-Modified" in cached["headers"]:
+        conditional_headers["If-Modified-Since"] = cached["headers"]["Last-Modified"]
+
+    with _semaphore:
+        response = session.get(
+            full_url, headers={**headers, **conditional_headers}, timeout=timeout
+        )
+
+    if cached and response.status_code == 304:
+        cached["time"] = time.time()
+        _store(key, cached)
+        return _to_response(cached)
+    if response.ok and "no-store" not in response.headers.get("Cache-Control", ""):
+        _store(
+            key,
+            {
+                "time": time.time(),
+                "url": response.url,
+                "status_code": response.status_code,
+                "headers": dict(response.headers),
+                "encoding": response.encoding,
+                "content": response.content,
+            },
+        )
+    return response
+
+
+def _paths(key: str):
+    return os.path.join(CACHE_DIR, f"{key}.json"), os.path.join(CACHE_DIR, key)
+
+
+def _load(key: str) -> Optional[Dict[str, Any]]:
+    meta_path, content_path = _paths(key)
+    try:
+        with open(meta_path) as f:
+            cached = json.load(f)
+        with open(content_path, "rb") as f:
+            cached["content"] = f.read()
+        cached["headers"] = CaseInsensitiveDict(cached["headers"])
+        return cached
+    except (OSError, ValueError):
+        return None
+
+
+def _store(key: str, cached: Dict[str, Any]) -> None:
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    meta_path, content_path = _paths(key)
+    meta = {k: v for k, v in cached.items() if k != "content"}
+    meta["headers"] = dict(meta["headers"])
+    # Write to temporary files first, so concurrent readers never see partial files.
+    for path, data in [
+        (content_path, cached["content"]),
+        (meta_path, json.dumps(meta).encode()),
+    ]:
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+
+def _to_response(cached: Dict[str, Any]) -> requests.Response:
+    response = requests.Response()
+    response.url = cached["url"]
+    response.status_code = cached["status_code"]
+    response.headers = CaseInsensitiveDict(cached["headers"])
+    response.encoding = cached["encoding"]
+    response._content = cached["content"]
+    response.reason = "OK"
+    return response